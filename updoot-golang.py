@@ -9,12 +9,30 @@ import platform
 import hashlib
 import argparse
 import re
+import queue
+import threading
+import subprocess
+import json
+import functools
+import concurrent.futures
+
+# orjson is a lot faster at parsing the version list, but it's optional
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 # TODO: detect from environment or `go env GOROOT` or shutil.which() if set to None
 GOROOT = '/usr/local/go'
 
 GOWEBSITE = 'https://golang.org'
 
+# shared so the archive download can reuse the connection from the version list
+SESSION = requests.Session()
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(
+    '~/.cache'), 'updoot-golang')
+
 # dicts map from Python names to Go names
 # TODO: support more OS's/arch's
 
@@ -29,6 +47,11 @@ ARCH_DICT = {
 
 INT_REGEX = re.compile(r'\d+')
 
+# the archive is ~150 MB, so read it in big chunks
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# how many chunks the network thread is allowed to get ahead by
+DOWNLOAD_QUEUE_SIZE = 8
+
 
 def detect_platform():
     def platform_unsupported():
@@ -54,129 +77,347 @@ def detect_platform():
     return opsys, arch
 
 
+# the cache is only an optimization, so failing to use it is never fatal
+
+
+def read_cache(name):
+    try:
+        with open(os.path.join(CACHE_DIR, name), 'rb') as f:
+            return json_loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def write_cache(name, data):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # write then rename, so a concurrent run never sees half a file
+        with tempfile.NamedTemporaryFile('w', dir=CACHE_DIR, delete=False) as f:
+            json.dump(data, f)
+        os.replace(f.name, os.path.join(CACHE_DIR, name))
+    except IOError:
+        pass
+
+
 def get_versions(all, unstable):
     url = '{}/dl/?mode=json'.format(GOWEBSITE)
+    cache_name = 'versions.json'
     if all or unstable:
         url += '&include=all'
-
-    resp = requests.get(url)
-    if resp.status_code != 200:
+        cache_name = 'versions-all.json'
+
+    # only redownload the list if it changed since last time
+    headers = {}
+    cached = read_cache(cache_name)
+    if cached != None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    resp = SESSION.get(url, headers=headers)
+    if resp.status_code == 304 and cached != None:
+        versions = cached['versions']
+    elif resp.status_code == 200:
+        versions = json_loads(resp.content)
+        write_cache(cache_name, {
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'versions': versions,
+        })
+    else:
         print('remote returned status {}'.format(resp.status_code))
         sys.exit(1)
-    versions = resp.json()
 
     if not unstable:
-        versions = list(filter(lambda v: v['stable'], versions))
+        versions = [v for v in versions if v['stable']]
     return versions
 
-# True if b is more recent than a
-
-
-def cmp_versions(a, b):
-    def replace_none_with_zero_tuple(value):
-        if value is None:
-            return (0,)
-        return value
-
-    a_major = replace_none_with_zero_tuple(INT_REGEX.search(a))
-    b_major = replace_none_with_zero_tuple(INT_REGEX.search(b))
-    a_major_int, b_major_int = int(a_major[0]), int(b_major[0])
-    if a_major_int != b_major_int:
-        return b_major_int > a_major_int
-
-    a_minor = replace_none_with_zero_tuple(INT_REGEX.search(a, a_major.end()))
-    b_minor = replace_none_with_zero_tuple(INT_REGEX.search(b, b_major.end()))
-    a_minor_int, b_minor_int = int(a_minor[0]), int(b_minor[0])
-    if a_minor_int != b_minor_int:
-        return b_minor_int > a_minor_int
-
-    a_beta, a_rc = 'beta' in a, 'rc' in a
-    b_beta, b_rc = 'beta' in b, 'rc' in b
-
-    if a_beta == b_beta and a_rc == b_rc:
-        a_patch = replace_none_with_zero_tuple(
-            INT_REGEX.search(a, a_minor.end()))
-        b_patch = replace_none_with_zero_tuple(
-            INT_REGEX.search(b, b_minor.end()))
-        if b_patch is None:
-            b_patch = (0,)
-        a_patch_int, b_patch_int = int(a_patch[0]), int(b_patch[0])
-        return b_patch_int > a_patch_int
+# sort key for version strings, newer ones compare greater
+# go1.21.0 > go1.21rc2 > go1.21beta1, so stability goes before the last number
+# memoized so each string only goes through the regex once per run
+
+
+@functools.lru_cache(maxsize=None)
+def parse_version(s):
+    nums = [int(n) for n in INT_REGEX.findall(s)] + [0, 0, 0]
+    if 'beta' in s:
+        stability = 0
+    elif 'rc' in s:
+        stability = 1
     else:
-        # is a release and b prerelease?
-        if not (a_beta or a_rc) and (b_beta or b_rc):
-            return False
-        # is b release and a prerelease?
-        elif not (b_beta or b_rc) and (a_beta or a_rc):
+        stability = 2
+    return (nums[0], nums[1], stability, nums[2])
+
+
+def version_key(version):
+    return parse_version(version['version'])
+
+
+def find_latest_version(versions):
+    return max(versions, key=version_key)
+
+# yields the body of a streamed response
+# the network reads happen on a background thread, so whatever the caller
+# does with each chunk (writing, hashing) overlaps with the download
+
+
+def stream_response(resp):
+    chunks = queue.Queue(DOWNLOAD_QUEUE_SIZE)
+
+    def reader():
+        try:
+            while True:
+                chunk = resp.raw.read(DOWNLOAD_CHUNK_SIZE, decode_content=True)
+                if not chunk:
+                    break
+                chunks.put(chunk)
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
+    thread.join()
+
+
+# src can be '-' to read the archive from stdin
+# gzip can't be inflated in parallel, but pigz still moves reading, writing and
+# checksumming onto their own threads, so it beats plain gzip
+# some distros only ship it as unpigz
+
+
+def tar_command(src, dest):
+    for decompressor in ('pigz', 'unpigz'):
+        if shutil.which(decompressor):
+            return ['tar', '--use-compress-program={}'.format(decompressor),
+                    '-xf', src, '-C', dest]
+    return ['tar', '-xzf', src, '-C', dest]
+
+# extracts with the system tar/unzip when possible, since Python's tarfile and
+# gzip modules are a lot slower on an archive this size
+# without fallback, failures are silent and just return False (or None if
+# there was no tar/unzip to try), for when the archive might turn out to be
+# corrupt anyway
+
+
+def extract_archive(path, dest, filename, fallback=True):
+    if filename.endswith('.tar.gz'):
+        cmd = tar_command(path, dest)
+        archive_format = 'gztar'
+    else:
+        cmd = ['unzip', '-q', path, '-d', dest]
+        archive_format = 'zip'
+
+    if shutil.which(cmd[0]):
+        output = None if fallback else subprocess.DEVNULL
+        if subprocess.run(cmd, stdout=output, stderr=output).returncode == 0:
             return True
-        # is a release candidate and b beta?
-        elif a_rc and b_beta:
+        if not fallback:
             return False
-        # is b release candidate and a beta?
-        elif b_rc and a_beta:
-            return True
-        # either the versions are the same or the version strings are very weird
-        return False
+        print('{} failed, falling back to Python extraction'.format(cmd[0]))
+        # start over from an empty directory
+        shutil.rmtree(dest)
+        os.mkdir(dest)
+    elif not fallback:
+        return None
+    shutil.unpack_archive(path, dest, archive_format)
+    return True
 
 
-def find_latest_version(versions):
-    latest = versions[0]
-    for version in versions[1:]:
-        if cmp_versions(latest['version'], version['version']):
-            latest = version
-    return latest
+# hashlib.file_digest (3.11+) runs the whole loop in C without holding the GIL
+
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        file_hash = hashlib.sha256()
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+# pipes the download straight into tar so the archive is never read back from
+# the disk, only saved to download for next time
+# returns whether tar was happy, but always hashes and saves the whole download
+
+
+def stream_extract(resp, dest, download_hash, download):
+    proc = subprocess.Popen(tar_command('-', dest), stdin=subprocess.PIPE)
+    update, write, save = download_hash.update, proc.stdin.write, download.write
+    chunks = stream_response(resp)
+    try:
+        try:
+            for chunk in chunks:
+                update(chunk)
+                save(chunk)
+                write(chunk)
+            proc.stdin.close()
+        except BrokenPipeError:
+            # tar gave up early, but finish the download anyway so the hash can
+            # tell a corrupt archive apart from a tar problem
+            for chunk in chunks:
+                update(chunk)
+                save(chunk)
+    except BaseException:
+        # the download itself died, so don't leave tar waiting for the rest
+        proc.terminate()
+        raise
+    finally:
+        # closing the pipe matters too, since tar's decompressor reads it
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
+    return proc.returncode == 0
+
+# downloads are kept in the cache, so reinstalling (or retrying after
+# something went wrong) doesn't have to download them again
+# they're named partial-* until they've been verified
+
+
+def open_download():
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        return tempfile.NamedTemporaryFile(prefix='partial-', dir=CACHE_DIR, delete=False)
+    except IOError:
+        return tempfile.NamedTemporaryFile(prefix='partial-', delete=False)
+
+
+# returns whether it made it into the cache; if not, it's still at download.name
+
+
+def save_download(download, archive):
+    try:
+        os.replace(download.name, archive)
+    except IOError:
+        # probably fell back to a temporary directory elsewhere
+        return False
+    # only the newest archive is worth keeping around, and leftovers from
+    # failed downloads aren't worth keeping at all
+    for name in os.listdir(CACHE_DIR):
+        is_archive = name.startswith('go') and (
+            name.endswith('.tar.gz') or name.endswith('.zip'))
+        if name != os.path.basename(archive) and (is_archive or name.startswith('partial-')):
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except IOError:
+                pass
+    return True
+
+# None if there's nothing (recognizable) installed
+
+
+def installed_version():
+    try:
+        with open(os.path.join(GOROOT, 'VERSION')) as f:
+            # newer releases put more lines after the version
+            return f.readline().strip()
+    except IOError:
+        return None
 
 
 def install_file(file):
-    # TODO check installed version before downloading
+    if installed_version() == file['version']:
+        print('{} is already installed at {}'.format(file['version'], GOROOT))
+        return
+
     print('+ Installing {}'.format(file['version']))
 
-    olddir = tempfile.TemporaryDirectory()
+    # keep temporary directories on the same filesystem as GOROOT, so moving
+    # things in and out of it is a rename rather than a copy
+    staging = os.path.dirname(GOROOT)
+
+    # the old installation isn't touched until the new one is ready, but
+    # check now that we'll be allowed to, before downloading anything
     try:
-        shutil.move(GOROOT, olddir.name)
+        extract_dir = tempfile.TemporaryDirectory(dir=staging)
     except IOError as e:
-        olddir.cleanup()
-        olddir = None
-        if e.errno == 2:
-            # no old version to remove
-            print('No existing Go installation at {}, ignoring'.format(GOROOT))
-        else:
-            print('Failed to remove old Go installation:')
-            print(e)
-            if e.errno == 13:
-                # permission denied
-                print('(maybe you need to be root?)')
-            sys.exit(1)
-
-    download = tempfile.NamedTemporaryFile(delete=False)
-    download_hash = hashlib.sha256()
-    download_resp = requests.get(
-        '{}/dl/{}'.format(GOWEBSITE, file['filename']), stream=True)
-    if download_resp.status_code != 200:
-        print('remote returned status {}'.format(download_resp.status_code))
-        download.delete = True
-        download.close()
+        print('Failed to create a directory next to {}:'.format(GOROOT))
+        print(e)
+        if e.errno == 13:
+            # permission denied
+            print('(maybe you need to be root?)')
         sys.exit(1)
 
-    print('Downloading archive...')
-    # TODO provide some form of progress indicator
-    # maybe use curl if available?
-    for chunk in download_resp.iter_content(65536):
-        # if you don't specify a chunk_size then iter_content apparently reads bytes one at a time
-        # why the hecc is that the default behavior?? who would ever want that?? who knows
-        # print(len(chunk))
-        download.write(chunk)
-        download_hash.update(chunk)
-    print('Archive downloaded.')
-    download.close()
-    if download_hash.hexdigest() == file['sha256']:
+    # nothing gets installed until the hash checks out, so it's safe to
+    # extract before verifying
+    # extraction doesn't fall back to Python here, since that would be wasted
+    # on a corrupt archive; that's decided once the hash is known
+    def hash_and_extract(path, extract_dir):
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            hashed = executor.submit(file_sha256, path)
+            extracted = executor.submit(
+                extract_archive, path, extract_dir.name, file['filename'], False)
+            return hashed.result(), extracted.result()
+
+    archive = os.path.join(CACHE_DIR, file['filename'])
+    download = None
+    digest = None
+    if os.path.exists(archive):
+        print('Verifying and extracting cached archive...')
+        source = archive
+        digest, extracted = hash_and_extract(archive, extract_dir)
+        if digest != file['sha256']:
+            print('Cached archive is corrupt, downloading it again')
+            os.remove(archive)
+            extract_dir.cleanup()
+            extract_dir = tempfile.TemporaryDirectory(dir=staging)
+            digest = None
+
+    if digest == None:
+        # the archive is already compressed, and the hash is of the raw bytes
+        download_resp = SESSION.get(
+            '{}/dl/{}'.format(GOWEBSITE, file['filename']), stream=True,
+            headers={'Accept-Encoding': 'identity'})
+        if download_resp.status_code != 200:
+            print('remote returned status {}'.format(download_resp.status_code))
+            sys.exit(1)
+
+        download = open_download()
+        source = download.name
+        try:
+            # TODO provide some form of progress indicator
+            # maybe use curl if available?
+            if file['filename'].endswith('.tar.gz') and shutil.which('tar'):
+                print('Downloading and extracting archive...')
+                download_hash = hashlib.sha256()
+                extracted = stream_extract(
+                    download_resp, extract_dir.name, download_hash, download)
+                print('Archive downloaded.')
+                download.close()
+                digest = download_hash.hexdigest()
+            else:
+                print('Downloading archive...')
+                # just a plain copy now that hashing happens afterwards
+                download_resp.raw.decode_content = True
+                shutil.copyfileobj(download_resp.raw, download, DOWNLOAD_CHUNK_SIZE)
+                print('Archive downloaded.')
+                download.close()
+
+                print('Verifying and extracting archive...')
+                digest, extracted = hash_and_extract(download.name, extract_dir)
+        except BaseException:
+            # don't leave half a download lying around in the cache
+            download.close()
+            os.remove(download.name)
+            raise
+
+    if digest == file['sha256']:
         print('Verification succeeded.')
     else:
-        shutil.move(os.path.join(
-            olddir.name, os.path.basename(GOROOT)), GOROOT)
+        extract_dir.cleanup()
         print('Verification failed!')
         print('Expected hash: {}'.format(file['sha256']))
-        print('Actual hash: {}'.format(download_hash.hexdigest()))
+        print('Actual hash: {}'.format(digest))
         print('tbh I have no idea how this would happen')
         print('maybe some sort of weird network problem?')
         print('presumably they would provide the hash for a reason')
@@ -186,20 +427,57 @@ def install_file(file):
         print('otherwise try again later I guess')
         sys.exit(1)
 
-    print('Extracting archive...')
-    extract_dir = tempfile.TemporaryDirectory()
-    if file['filename'].endswith('.tar.gz'):
-        shutil.unpack_archive(download.name, extract_dir.name, 'gztar')
-    else:
-        shutil.unpack_archive(download.name, extract_dir.name, 'zip')
+    # cache it right away, so it's kept even if extracting goes wrong
+    if download != None and save_download(download, archive):
+        source = archive
+    try:
+        if extracted == False:
+            # the archive is fine, so whatever went wrong was the extractor's fault
+            # this time extract_archive is allowed to fall back to Python
+            print('Extraction failed, trying again...')
+            extract_dir.cleanup()
+            extract_dir = tempfile.TemporaryDirectory(dir=staging)
+            extract_archive(source, extract_dir.name, file['filename'])
+        elif extracted == None:
+            # no tar/unzip, so it's Python's job and nothing has been tried yet
+            print('Extracting archive...')
+            extract_archive(source, extract_dir.name, file['filename'])
+    finally:
+        if source != archive:
+            os.remove(source)
     print('Archive extracted.')
-    shutil.move(os.path.join(extract_dir.name, "go"), GOROOT)
+
+    # set the old installation aside with a plain rename, so putting it back
+    # (or not) is cheap
+    backup = '{}.old.{}'.format(GOROOT, os.getpid())
+    try:
+        os.rename(GOROOT, backup)
+    except IOError as e:
+        backup = None
+        if e.errno == 2:
+            # no old version to remove
+            print('No existing Go installation at {}, ignoring'.format(GOROOT))
+        else:
+            print('Failed to remove old Go installation:')
+            print(e)
+            if e.errno == 13:
+                # permission denied
+                print('(maybe you need to be root?)')
+            sys.exit(1)
+
+    try:
+        shutil.move(os.path.join(extract_dir.name, "go"), GOROOT)
+    except BaseException:
+        if backup != None:
+            # clear out anything a half-finished copy left behind first
+            shutil.rmtree(GOROOT, ignore_errors=True)
+            os.rename(backup, GOROOT)
+        raise
     print('Successfully installed {}.'.format(file['version']))
 
-    os.remove(download.name)
-    if olddir != None:
-        # takes the old Go installation with it, sayonara
-        olddir.cleanup()
+    if backup != None:
+        # sayonara, old Go installation
+        shutil.rmtree(backup)
 
 
 def install_version(version):
@@ -218,7 +496,12 @@ def install_version(version):
 
 def install_latest(args):
     versions = get_versions(args.all, args.unstable)
-    install_version(find_latest_version(versions))
+    # the stable list comes newest first, so trust that unless it looks off
+    if not args.unstable and (len(versions) == 1 or version_key(versions[0]) > version_key(versions[1])):
+        latest = versions[0]
+    else:
+        latest = find_latest_version(versions)
+    install_version(latest)
 
 
 def install(args):